@@ -0,0 +1,249 @@
+"""Run the real midi_art frame loop headless against scripted MIDI input.
+
+Every workload runs in its own process with the SDL dummy video driver, a
+VirtualMidiIn in place of rtmidi.MidiIn and no sound output. Results are
+written as JSON so runs of different versions can be compared:
+
+    python benchmark.py --seconds 10 --out benchmark.json
+    python benchmark.py chords trills --fps 0
+"""
+import argparse
+import json
+import os
+import platform
+import random
+import resource
+import subprocess
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from types import SimpleNamespace
+
+os.environ.setdefault("SDL_VIDEODRIVER", "dummy")
+os.environ.setdefault("SDL_AUDIODRIVER", "dummy")
+
+import numpy as np
+import pygame
+
+import midi_art
+
+NOTE_ON = 144
+NOTE_OFF = 128
+RSS_INTERVAL = .25  # Seconds between memory samples
+
+def chords(seconds: float, rng: random.Random) -> list:
+    """Ten-note chords twice a second, held for most of the beat"""
+    events = []
+    for beat in range(int(seconds * 2)):
+        start = beat / 2
+        root = rng.randrange(midi_art.PITCH_MIN, midi_art.PITCH_MAX - 24)
+        pitches = sorted(rng.sample(range(root, root + 24), 10))
+        for pitch in pitches:
+            events.append((start, [NOTE_ON, pitch, rng.randrange(60, 128)]))
+            events.append((start + .4, [NOTE_OFF, pitch, 0]))
+    return events
+
+def trills(seconds: float, rng: random.Random) -> list:
+    """Two hands trilling at 16 notes a second each"""
+    events = []
+    for step in range(int(seconds * 16)):
+        start = step / 16
+        for low in (48, 67):
+            pitch = low + step % 2
+            events.append((start, [NOTE_ON, pitch, rng.randrange(40, 110)]))
+            events.append((start + 1/20, [NOTE_OFF, pitch, 0]))
+    return events
+
+def sustain(seconds: float, rng: random.Random) -> list:
+    """Ten notes held long enough for the first dots to expire"""
+    seconds = max(seconds, midi_art.NOTE_LIFETIME + 5)
+    pitches = rng.sample(range(midi_art.PITCH_MIN, midi_art.PITCH_MAX), 10)
+    return ([(0, [NOTE_ON, pitch, 127]) for pitch in pitches]
+            + [(seconds, [NOTE_OFF, pitch, 0]) for pitch in pitches])
+
+WORKLOADS = {
+    "chords": (chords, {}),
+    "trills": (trills, {}),
+    "sustain": (sustain, {}),
+    "scrolling": (chords, {"scrolling": True}),
+    "gradients": (chords, {"gradients": True}),
+    # Three performers on their own ports
+    "ensemble": (chords, {"input_ports": [0, 1, 2]}),
+}
+
+class VirtualMidiIn:
+    """Stands in for rtmidi.MidiIn, plays a script of (seconds, message) events.
+
+    Every opened port plays the next of scripts, starting when it is opened.
+    Once it is over a QUIT event is posted so main() returns.
+    """
+
+    scripts = [[]]
+    opened = 0
+    tail = 1.0  # Seconds to keep running after the last event
+
+    def __init__(self):
+        self.script = []
+        self.start = None
+        self.next_event = 0
+        self.last_time = 0.0
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def get_ports(self):
+        return [f"Virtual MIDI {port + 1}" for port in range(max(2, len(self.scripts)))]
+
+    def open_port(self, port=0):
+        self.script = self.scripts[VirtualMidiIn.opened % len(self.scripts)]
+        VirtualMidiIn.opened += 1
+        self.start = time.perf_counter()
+        threading.Thread(target=self._quit_when_done, daemon=True).start()
+
+    def close_port(self):
+        self.stopped.set()
+
+    def get_message(self):
+        if self.next_event < len(self.script):
+            event_time, message = self.script[self.next_event]
+            if self.start + event_time <= time.perf_counter():
+                self.next_event += 1
+                delta_time = event_time - self.last_time
+                self.last_time = event_time
+                return message, delta_time
+        return None
+
+    def set_callback(self, callback, data=None):
+        self.thread = threading.Thread(target=self._run_callback, args=(callback, data), daemon=True)
+        self.thread.start()
+
+    def cancel_callback(self):
+        self.stopped.set()
+
+    def _run_callback(self, callback, data):
+        while not self.stopped.is_set() and self.next_event < len(self.script):
+            event_time = self.script[self.next_event][0]
+            if self.stopped.wait(max(0.0, self.start + event_time - time.perf_counter())):
+                return
+            callback(self.get_message(), data)
+
+    def _quit_when_done(self):
+        end = self.script[-1][0] + self.tail if self.script else self.tail
+        if not self.stopped.wait(max(0.0, self.start + end - time.perf_counter())):
+            pygame.event.post(pygame.event.Event(pygame.QUIT))
+
+class NullOutput:
+    def note_on(self, *args):
+        pass
+
+    def note_off(self, *args):
+        pass
+
+    def set_instrument(self, *args):
+        pass
+
+    def close(self):
+        pass
+
+def current_rss() -> int:
+    """Resident memory in bytes, the peak so far where /proc is missing"""
+    try:
+        with open("/proc/self/statm") as statm:
+            return int(statm.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except OSError:
+        return peak_rss()
+
+def peak_rss() -> int:
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes
+    return peak if platform.system() == "Darwin" else peak * 1024
+
+def run_workload(name: str, seconds: float, fps: int, seed: int, callback_input: bool) -> dict:
+    generate, options = WORKLOADS[name]
+    # A differently seeded script for every port
+    VirtualMidiIn.scripts = [sorted(generate(seconds, random.Random(seed + port)), key=lambda event: event[0])
+                             for port in range(len(options.get("input_ports", [0])))]
+    # Replaces the whole module, so the benchmark runs where rtmidi can't load
+    midi_art.rtmidi = SimpleNamespace(MidiIn=VirtualMidiIn)
+    midi_art.setup_midi_output = NullOutput
+
+    memory = []
+    done = threading.Event()
+    def sample_memory():
+        while not done.wait(RSS_INTERVAL):
+            memory.append((time.perf_counter(), current_rss()))
+    sampler = threading.Thread(target=sample_memory, daemon=True)
+    sampler.start()
+
+    profiler = midi_art.FrameProfiler(window=None)
+    midi_art.main(fps=fps, callback_input=callback_input, profiler=profiler, session=None, **options)
+    done.set()
+    sampler.join()
+
+    frames = np.array(profiler.frames) * 1000
+    note_counts = np.array(profiler.note_counts)
+    # Memory against the live note count at the time it was sampled
+    frame_starts = np.array(profiler.frame_starts)
+    memory_by_notes = [{"notes": int(note_counts[max(0, np.searchsorted(frame_starts, sample_time) - 1)]),
+                        "rss_mb": round(rss / 2**20, 2)}
+                       for sample_time, rss in memory if len(frame_starts)]
+    return {
+        "options": options,
+        "frames": len(frames),
+        "seconds": round(float(frames.sum()) / 1000, 3),
+        "fps": round(len(frames) / (frames.sum() / 1000), 2),
+        "frame_ms": distribution(frames),
+        "stage_ms": {stage: distribution(np.array(times) * 1000) for stage, times in profiler.stages.items()},
+        "latency_ms": distribution(np.array(profiler.latencies) * 1000),
+        "max_notes": int(note_counts.max(initial=0)),
+        "peak_rss_mb": round(peak_rss() / 2**20, 2),
+        "memory_by_notes": memory_by_notes,
+    }
+
+def distribution(values: np.ndarray) -> dict:
+    if not len(values):
+        return {}
+    p50, p90, p99 = np.percentile(values, (50, 90, 99))
+    return {"mean": round(float(values.mean()), 3), "p50": round(float(p50), 3), "p90": round(float(p90), 3),
+            "p99": round(float(p99), 3), "max": round(float(values.max()), 3)}
+
+def version() -> str:
+    try:
+        return subprocess.run(["git", "describe", "--always", "--dirty"], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except OSError:
+        return ""
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    # Checked after parsing, argparse before 3.12 rejects an empty list against choices
+    parser.add_argument("workloads", nargs="*", metavar="workload",
+                        help="workloads to run, all by default: " + ", ".join(WORKLOADS))
+    parser.add_argument("--seconds", type=float, default=10, help="length of each workload")
+    # Capped like the live program, so frame and stage times compare from run to run
+    parser.add_argument("--fps", type=int, default=60, help="frame rate cap, 0 runs as fast as possible")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--polling", action="store_true", help="poll for input instead of the rtmidi callback")
+    parser.add_argument("--out", default="benchmark.json")
+    args = parser.parse_args()
+    args.workloads = args.workloads or list(WORKLOADS)
+    for name in args.workloads:
+        if name not in WORKLOADS:
+            parser.error(f"unknown workload {name!r}, choose from " + ", ".join(WORKLOADS))
+
+    results = {"version": version(), "python": platform.python_version(), "pygame": pygame.version.ver,
+               "machine": platform.machine(), "seconds": args.seconds, "fps_cap": args.fps, "seed": args.seed,
+               "workloads": {}}
+    for name in args.workloads:
+        # A fresh process each, so peak memory belongs to one workload
+        with ProcessPoolExecutor(max_workers=1) as pool:
+            result = pool.submit(run_workload, name, args.seconds, args.fps, args.seed, not args.polling).result()
+        results["workloads"][name] = result
+        print(f"{name}: {result['fps']} fps, frame p50 {result['frame_ms']['p50']} ms"
+              f" p99 {result['frame_ms']['p99']} ms, {result['max_notes']} notes, {result['peak_rss_mb']} MB")
+
+    with open(args.out, "w") as out:
+        json.dump(results, out, indent=2)
+    print("wrote " + args.out)
+
+if __name__ == "__main__":
+    main()
@@ -1,8 +1,23 @@
-import rtmidi
+import csv
+import glob
+import heapq
+import json
+import os
+import queue
+import sys
 import time
+import threading
+import zlib
+from bisect import bisect_left
+from collections import OrderedDict, deque
+import numpy as np
 import pygame
 import pygame.midi
-from mido import MidiFile, MidiTrack, Message, MetaMessage
+from mido import MidiFile, MidiTrack, Message
+try:
+    import rtmidi
+except ImportError:  # Offline rendering needs no MIDI input, rtmidi fails to load without ALSA
+    rtmidi = None
 
 SCREEN_WIDTH = 1280  # Width for pitch mapping
 SCREEN_HEIGHT = 720  # Height for time looping (8 seconds)
@@ -24,48 +39,1032 @@ BLACK = ((0,0,0))
 NOTE_COLORS = [(255, 3, 5), SKIN_TONE, (16, 68, 126), BROWN, YELLOW, BLACK, GREEN]
 LINE_WIDTH = 4
 KEY_BORDER_RADIUS = 16
+NOTE_LIFETIME = 30  # Seconds before a note is baked into the background
+SPRITE_CACHE_SIZE = 256
+COLORKEYS = ((255, 0, 255), (0, 255, 0))  # Transparent sprite pixels, never both a note color
+TILE_WIDTH = 160
+TILE_HEIGHT = 144
+TILE_COLUMNS = -(-SCREEN_WIDTH // TILE_WIDTH)
+TILE_ROWS = -(-SCREEN_HEIGHT // TILE_HEIGHT)
+SEEK_STEP = 5  # Seconds skipped by the arrow keys during playback
+PLAYLIST_PATTERN = "recorded_output*.mid"  # Files played in name order by the p key
+LOADER_CACHE_SIZE = 8  # Decoded MIDI files kept in memory
+LOAD_CHUNK = 1024  # Notes per chunk streamed from the loader to the player
+FRAME_BUDGET = 1/60
+MAX_FRAME_STEPS = 30  # Most dots interpolated along a stroke after a long frame
+SCROLL_SPEED = 120  # Pixels per second notes move up while scrolling
+# Quality levels the governor steps through as frames run over budget
+QUALITY_FULL = 0
+QUALITY_FLAT_COLORS = 1  # No gradients
+QUALITY_NO_OUTLINES = 2  # No white outline around held notes
+QUALITY_MERGED_DOTS = 3  # No interpolation, dots only every other frame
+PROFILE_WINDOW = 600  # Frames kept for the profiler percentiles
+JOURNAL_MAGIC = b"MIDIART\x01"  # Start of every recording journal
+JOURNAL_FLUSH_TIME = 1.0  # Seconds of recording that can be lost in a crash
+# Recorded messages as they are written to the journal
+JOURNAL_DTYPE = np.dtype([("time", "<f8"), ("status", "u1"), ("data1", "u1"), ("data2", "u1")])
+SNAPSHOT_MAGIC = b"MIDIARTS"  # Start of every session snapshot
+AUTOSAVE_TIME = 60  # Seconds between session snapshots
+PROFILE_STAGES = ("events", "midi", "notes", "draw", "marker", "held", "hud", "display", "tick")
+
+# One row per painted dot, stored column-wise so whole columns can be updated at once
+NOTE_DTYPE = np.dtype([
+    ("x", np.int32),
+    ("y", np.int32),
+    ("color_index", np.uint8),
+    ("pitch", np.uint8),
+    ("velocity", np.float32),
+    ("time", np.float64),
+    ("stroke", np.uint32),  # Every note on starts a new stroke, undo removes whole strokes
+    ("alive", np.bool_),  # False once undone
+])
+
+# The output is shared by the render loop and the playback thread
+midi_output_lock = threading.RLock()
 
 def setup_midi_output():
     pygame.midi.init()
     return pygame.midi.Output(pygame.midi.get_default_output_id())
 
-def play_note(midi_output, pitch, velocity):
-    if velocity > 0:
-        midi_output.note_on(pitch, velocity)
-    else:
-        midi_output.note_off(pitch)
+def play_note(midi_output, pitch, velocity, channel=0):
+    with midi_output_lock:
+        if velocity > 0:
+            midi_output.note_on(pitch, velocity, channel)
+        else:
+            midi_output.note_off(pitch, 0, channel)
 
 def play_special_note(midi_output, pitch, velocity= 50):
-    midi_output.set_instrument(5)
-    play_note(midi_output, pitch, velocity)
-    midi_output.set_instrument(0)
+    with midi_output_lock:
+        midi_output.set_instrument(5)
+        play_note(midi_output, pitch, velocity)
+        midi_output.set_instrument(0)
+
+def update_held_notes(held_notes: dict, status, note, velocity):
+    """note is whatever held_notes is keyed by, the pitch or (port, pitch)"""
+    if status == 144 and velocity > 0:  # Note On
+        held_notes[note] = velocity
+    elif status == 128:# or (status == 144 and velocity == 0):  # Note Off
+        if note in held_notes:
+            held_notes.pop(note)
+        # No removal of notes, only updating color on loop reset
+
+def decay_velocity(velocity):
+    """Held notes shrink a little every frame"""
+    # return max(0, (velocity -.1 - 10000/max(1,pow(velocity,3))))
+    # return max(0, velocity*.9933 - (4/max(1,velocity)))
+    return max(0, velocity*.997 - (4.5/max(1,velocity)))
+
+def file_notes(messages):
+    """Yields (offset, status, pitch, velocity) for every note in messages with delta times in seconds"""
+    offset = 0.0
+    for message in messages:
+        offset += message.time
+        if message.type == "note_on" and message.velocity > 0:
+            yield offset, 144, message.note, message.velocity
+        elif message.type in ("note_on", "note_off"):
+            yield offset, 128, message.note, 0
+
+def echo_input(midi_output, events: deque, channel=0):
+    """rtmidi callback that plays notes the moment they arrive.
+
+    Runs on rtmidi's thread and appends (status, pitch, velocity, abs_time)
+    to events, which only the render loop pops from. Only channel messages
+    are kept. The channel the device sent on is dropped from status, notes
+    are played on channel instead.
+    """
+    def on_message(event, data=None):
+        message, delta_time = event
+        if len(message) != 3 or message[0] >= 0xF0:  # System messages have no channel
+            return
+        status, pitch, velocity = message
+        status &= 0xF0
+        if status == 144 and velocity > 0:  # Note On
+            play_note(midi_output, pitch, velocity, channel)
+        elif status == 128:  # Note Off
+            play_note(midi_output, pitch, 0, channel)
+        events.append((status, pitch, velocity, time.perf_counter()))
+    return on_message
+
+def find_input_ports(available_ports: list, wanted) -> list:
+    """Indices of the ports wanted by index or part of their name, in the order wanted"""
+    found = []
+    for port in wanted:
+        if isinstance(port, int):
+            matches = [port % len(available_ports)] if -len(available_ports) <= port < len(available_ports) else []
+        else:
+            matches = [index for index, name in enumerate(available_ports) if port.lower() in name.lower()]
+        if not matches:
+            print(f"No MIDI device matches {port!r}")
+        found += [index for index in matches if index not in found]
+    return found
+
+class MidiInputs:
+    """Any number of MIDI input ports merged into one stream in arrival order.
+
+    Every port has its own rtmidi.MidiIn, so with callbacks each one is
+    serviced on its own rtmidi thread and a busy device can't hold up the
+    others. Ports are numbered in the order they are opened. The number is
+    the channel a port is played and recorded on, and how many colors its
+    notes are shifted from the current one.
+    """
+
+    def __init__(self, midi_output, callback_input: bool = True):
+        self.midi_output = midi_output
+        self.callback_input = callback_input
+        self.ports = []  # (MidiIn, name, events, on_message)
+
+    def open(self, index: int, name: str):
+        midi_in = rtmidi.MidiIn()
+        midi_in.open_port(index)
+        events = deque()
+        on_message = echo_input(self.midi_output, events, self.channel(len(self.ports)))
+        if self.callback_input:
+            midi_in.set_callback(on_message)
+        self.ports.append((midi_in, name, events, on_message))
+        print(f"Connected to device: {name}")
+
+    @staticmethod
+    def channel(port: int) -> int:
+        return port % 16
+
+    @property
+    def pending(self) -> int:
+        return sum(len(events) for _, _, events, _ in self.ports)
+
+    def drain(self) -> list:
+        """(status, pitch, velocity, abs_time, port) for every message since last call, oldest first"""
+        batches = []
+        for port, (midi_in, _, events, on_message) in enumerate(self.ports):
+            if not self.callback_input:
+                while msg := midi_in.get_message():
+                    on_message(msg)
+            # Only what is there now, the callback may still be appending
+            batches.append([events.popleft() + (port,) for _ in range(len(events))])
+        if len(batches) == 1:
+            return batches[0]
+        return list(heapq.merge(*batches, key=lambda event: event[3]))
+
+    def close(self):
+        for midi_in, _, _, _ in self.ports:
+            if self.callback_input:
+                midi_in.cancel_callback()
+            midi_in.close_port()
+
+def write_image(data: bytes, size, filename: str):
+    pygame.image.save(pygame.image.frombuffer(data, size, "RGB"), filename)
+
+def append_journal(data: bytes, filename: str):
+    with open(filename, "ab") as journal:
+        journal.write(data)
+        journal.flush()
+        os.fsync(journal.fileno())
+
+def read_journal(filename: str) -> np.ndarray:
+    with open(filename, "rb") as journal:
+        if journal.read(len(JOURNAL_MAGIC)) != JOURNAL_MAGIC:
+            raise ValueError(filename + " is not a recording journal")
+        data = journal.read()
+    # A crash can leave half a record at the end
+    return np.frombuffer(data[:len(data) - len(data) % JOURNAL_DTYPE.itemsize], dtype=JOURNAL_DTYPE)
+
+def journal_to_midi(journal_filename: str, filename: str):
+    """Write the journal as a Standard MIDI File and delete it"""
+    records = read_journal(journal_filename)
+    midi_file = MidiFile()
+    track = MidiTrack()
+    # track.append(MetaMessage('set_tempo', tempo=500000)) #supposedly 120 BPM
+    midi_file.tracks.append(track)
+    # Round absolute ticks so rounding errors don't add up over a long take,
+    # files have the default tempo of 500000 microseconds per beat
+    ticks = np.round(records["time"] * midi_file.ticks_per_beat / .5).astype(np.int64)
+    last_tick = 0
+    for record, tick in zip(records.tolist(), ticks.tolist()):
+        track.append(Message.from_bytes(record[1:], time=max(0, tick - last_tick)))
+        last_tick = max(last_tick, tick)
+    midi_file.save(filename)
+    os.remove(journal_filename)
+
+def write_snapshot(filename: str, pixels: bytes, size, notes: np.ndarray, state: dict, compress: bool = True):
+    """Save the paint layer pixels, live notes and loop state in one file.
+
+    The file is the magic bytes, the length of a JSON header, the header,
+    then the RGB pixels (zlib compressed or raw) and the raw note array.
+    Note times are stored relative to the moment of saving.
+    """
+    if compress:
+        pixels = zlib.compress(pixels, 1)
+    header = json.dumps({
+        "size": list(size),
+        "compressed": compress,
+        "pixel_bytes": len(pixels),
+        "note_fields": list(NOTE_DTYPE.names),
+        "notes": len(notes),
+        "state": state,
+    }).encode()
+    # Replace the old snapshot only once the new one is complete
+    with open(filename + ".tmp", "wb") as snapshot:
+        snapshot.write(SNAPSHOT_MAGIC + len(header).to_bytes(4, "little") + header)
+        snapshot.write(pixels)
+        snapshot.write(notes.tobytes())
+        snapshot.flush()
+        os.fsync(snapshot.fileno())
+    os.replace(filename + ".tmp", filename)
+
+def read_snapshot(filename: str):
+    """Map a snapshot file, returns (pixels, size, notes, state)"""
+    data = np.memmap(filename, dtype=np.uint8, mode="r")
+    if bytes(data[:len(SNAPSHOT_MAGIC)]) != SNAPSHOT_MAGIC:
+        raise ValueError(filename + " is not a session snapshot")
+    start = len(SNAPSHOT_MAGIC) + 4
+    header_end = start + int.from_bytes(bytes(data[len(SNAPSHOT_MAGIC):start]), "little")
+    header = json.loads(bytes(data[start:header_end]))
+    if header["note_fields"] != list(NOTE_DTYPE.names):
+        raise ValueError(filename + " was saved by a different version")
+    pixels_end = header_end + header["pixel_bytes"]
+    pixels = data[header_end:pixels_end]
+    if header["compressed"]:
+        pixels = zlib.decompress(pixels)
+    notes = data[pixels_end:pixels_end + header["notes"] * NOTE_DTYPE.itemsize].view(NOTE_DTYPE)
+    return pixels, tuple(header["size"]), notes, header["state"]
+
+def session_state(color_index: int, current_time: float) -> dict:
+    # Held notes are left out, no note off comes for keys held before a restart
+    return {"color_index": color_index, "current_time": current_time}
+
+def save_session(file_writer: "FileWriter", filename: str, paint: "TiledLayer", drawn_notes: "NoteStore", state: dict):
+    """Snapshot the painting on the file writer thread"""
+    notes = drawn_notes.ordered()
+    notes = notes[notes["alive"]]  # Copies
+    notes["time"] -= time.perf_counter()
+    file_writer.save_snapshot(filename, pygame.image.tobytes(paint.surface, "RGB"), paint.surface.get_size(),
+                              notes, state)
+
+def next_file_number(prefix: str, suffix: str) -> int:
+    """One more than the highest number already used by prefix<number>suffix files"""
+    numbers = [0]
+    for filename in glob.glob(glob.escape(prefix) + "*" + glob.escape(suffix)):
+        number = filename[len(prefix):len(filename) - len(suffix)]
+        if number.isdigit():
+            numbers.append(int(number))
+    return max(numbers) + 1
+
+class FileWriter:
+    """Encodes and saves screenshots and recordings on a background thread.
+
+    Callers hand over copies, so the render loop never waits on the disk.
+    Jobs run in the order they were queued. Every finished save is appended
+    to finished as (filename, error or None).
+    """
+
+    def __init__(self):
+        self.jobs = queue.Queue()
+        self.finished = deque()
+        self.thread = threading.Thread(target=self._run, name="file-writer", daemon=True)
+        self.thread.start()
+
+    def save_image(self, surface: pygame.Surface, filename: str):
+        self.jobs.put((write_image, (pygame.image.tobytes(surface, "RGB"), surface.get_size(), filename), filename, True))
+
+    def append(self, data: bytes, filename: str):
+        """Add data to the end of a file, only reported if it fails"""
+        self.jobs.put((append_journal, (bytes(data), filename), filename, False))
+
+    def save_journal(self, journal_filename: str, filename: str):
+        self.jobs.put((journal_to_midi, (journal_filename, filename), filename, True))
+
+    def save_snapshot(self, filename: str, pixels: bytes, size, notes: np.ndarray, state: dict):
+        """Only reported if it fails"""
+        self.jobs.put((write_snapshot, (filename, pixels, size, notes, state), filename, False))
+
+    def close(self):
+        """Finish every queued save"""
+        self.jobs.put(None)
+        self.thread.join()
+
+    def _run(self):
+        while (job := self.jobs.get()) is not None:
+            write, args, filename, report = job
+            try:
+                write(*args)
+                if report:
+                    self.finished.append((filename, None))
+            except Exception as error:
+                self.finished.append((filename, error))
+
+class Recorder:
+    """Records raw MIDI messages into a preallocated buffer.
+
+    The buffer is appended to a journal file at least every JOURNAL_FLUSH_TIME
+    seconds, which becomes a .mid file when recording stops. Journals left by
+    a crash are turned into .mid files by recover_journals().
+    """
+
+    def __init__(self, file_writer: FileWriter, capacity: int = 4096):
+        self.file_writer = file_writer
+        self.buffer = np.zeros(capacity, dtype=JOURNAL_DTYPE)
+        self.count = 0
+        self.journal_filename = None
+        self.filename = None
+        self.start_time = 0.0
+        self.last_flush = 0.0
+
+    @property
+    def recording(self) -> bool:
+        return self.journal_filename is not None
+
+    def start(self, filename: str):
+        self.filename = filename
+        self.journal_filename = os.path.splitext(filename)[0] + ".journal"
+        self.count = 0
+        self.start_time = self.last_flush = time.perf_counter()
+        self.file_writer.append(JOURNAL_MAGIC, self.journal_filename)
+
+    def record(self, message, message_time: float):
+        if self.count == len(self.buffer):
+            self.flush()
+        self.buffer[self.count] = (message_time - self.start_time, *message)
+        self.count += 1
+
+    def flush_due(self, now: float):
+        """Call once a frame"""
+        if self.count and now - self.last_flush >= JOURNAL_FLUSH_TIME:
+            self.flush()
+
+    def flush(self):
+        self.file_writer.append(self.buffer[:self.count].tobytes(), self.journal_filename)
+        self.count = 0
+        self.last_flush = time.perf_counter()
+
+    def stop(self):
+        self.flush()
+        self.file_writer.save_journal(self.journal_filename, self.filename)
+        self.journal_filename = None
+
+def recover_journals(file_writer: FileWriter):
+    """Save recordings that were still being written when the program stopped"""
+    for journal_filename in glob.glob("*.journal"):
+        print("recovering " + journal_filename)
+        file_writer.save_journal(journal_filename, os.path.splitext(journal_filename)[0] + ".mid")
+
+class MidiLoader:
+    """Decodes MIDI files into JOURNAL_DTYPE arrays of (offset, status, pitch, velocity) on its own thread.
+
+    Decoded files are kept in a small LRU cache keyed by path and mtime, so a
+    file played again is not parsed again. stream() hands notes over in chunks
+    while the file is still being parsed. Files that could not be loaded are
+    appended to failed as (path, error).
+    """
+
+    def __init__(self, cache_size: int = LOADER_CACHE_SIZE):
+        self.cache_size = cache_size
+        self.cache = OrderedDict()
+        self.loading = {}  # key: (chunks parsed so far, queues of the streams waiting for more)
+        self.requests = deque()  # Keys to parse, streams go before prefetches
+        self.failed = deque()
+        self.closed = False
+        self.condition = threading.Condition()
+        self.thread = threading.Thread(target=self._run, name="midi-loader", daemon=True)
+        self.thread.start()
+
+    def stream(self, path: str):
+        """Iterator over chunks of the file's notes, waits for the loader when it gets ahead of the parse"""
+        key = self._key(path)
+        if key is None:
+            return iter(())
+        with self.condition:
+            if key in self.cache:
+                self.cache.move_to_end(key)
+                notes = self.cache[key]
+                return (notes[start:start + LOAD_CHUNK] for start in range(0, len(notes), LOAD_CHUNK))
+            if key not in self.loading:
+                self.loading[key] = ([], [])
+                self.requests.appendleft(key)
+            elif key in self.requests:
+                # A prefetch that has not started yet goes first now
+                self.requests.remove(key)
+                self.requests.appendleft(key)
+            chunks = queue.Queue()
+            parsed, waiting = self.loading[key]
+            for chunk in parsed:
+                chunks.put(chunk)
+            waiting.append(chunks)
+            self.condition.notify()
+        return self._drain(chunks)
+
+    def prefetch(self, path: str):
+        """Parse a file in the background so it streams from the cache later"""
+        key = self._key(path)
+        if key is None:
+            return
+        with self.condition:
+            if key not in self.cache and key not in self.loading:
+                self.loading[key] = ([], [])
+                self.requests.append(key)
+                self.condition.notify()
+
+    def close(self):
+        with self.condition:
+            self.closed = True
+            self.condition.notify()
+        self.thread.join()
+
+    def _key(self, path: str):
+        try:
+            return os.path.abspath(path), os.path.getmtime(path)
+        except OSError as error:
+            self.failed.append((path, error))
+            return None
+
+    @staticmethod
+    def _drain(chunks: queue.Queue):
+        while (chunk := chunks.get()) is not None:
+            yield chunk
+
+    def _run(self):
+        while True:
+            with self.condition:
+                while not self.requests and not self.closed:
+                    self.condition.wait()
+                if self.closed:
+                    return
+                key = self.requests.popleft()
+            self._load(key)
+
+    def _load(self, key):
+        path = key[0]
+        error = None
+        try:
+            notes = []
+            for note in file_notes(MidiFile(path)):
+                notes.append(note)
+                if len(notes) == LOAD_CHUNK:
+                    self._publish(key, notes)
+                    notes = []
+            self._publish(key, notes)
+        except Exception as load_error:
+            error = load_error
+        with self.condition:
+            parsed, waiting = self.loading.pop(key)
+            if error is None:
+                # An older version of the same file is never played again
+                for old_key in [old_key for old_key in self.cache if old_key[0] == path]:
+                    del self.cache[old_key]
+                self.cache[key] = np.concatenate(parsed) if parsed else np.zeros(0, dtype=JOURNAL_DTYPE)
+                while len(self.cache) > self.cache_size:
+                    self.cache.popitem(last=False)
+            else:
+                self.failed.append((path, error))
+            for chunks in waiting:
+                chunks.put(None)
+
+    def _publish(self, key, notes: list):
+        if not notes:
+            return
+        chunk = np.array(notes, dtype=JOURNAL_DTYPE)
+        with self.condition:
+            parsed, waiting = self.loading[key]
+            parsed.append(chunk)
+            for chunks in waiting:
+                chunks.put(chunk)
+
+class MidiPlayer:
+    """Plays a MIDI file to the output on its own thread.
+
+    Every note is sent at its own perf_counter deadline instead of once per
+    frame. Sent notes are also appended to events as (status, pitch, velocity)
+    so the render loop can draw them. Notes are pulled from the source only
+    LOOKAHEAD seconds ahead of the playhead, so playing starts before a file
+    is fully loaded.
+    """
+
+    SPIN_TIME = .001  # Final stretch before a deadline spent yielding instead of waiting
+    LOOKAHEAD = 2.0  # Seconds of notes pulled from the source ahead of the playhead
+
+    def __init__(self, midi_output):
+        self.midi_output = midi_output
+        self.events = deque()
+        self.condition = threading.Condition()
+        self.source = None  # Iterator over the chunks of notes not pulled yet
+        self.notes = []  # (offset, status, pitch, velocity), offsets in seconds from the start
+        self.offsets = []
+        self.pending = deque()
+        self.origin = 0.0  # perf_counter time at offset 0
+        self.position = 0.0  # Offset to continue from while paused
+        self.paused = False
+        self.stopped = True
+        self.sounding = set()
+        self.thread = None
+
+    @property
+    def playing(self) -> bool:
+        return self.thread is not None and self.thread.is_alive()
+
+    def play(self, chunks):
+        """Start playing chunks of notes as MidiLoader.stream() gives"""
+        self.stop()
+        with self.condition:
+            self.source = iter(chunks)
+            self.notes = []
+            self.offsets = []
+            self.paused = False
+            self.stopped = False
+            self._start_at(0.0)
+        self.thread = threading.Thread(target=self._run, name="midi-player", daemon=True)
+        self.thread.start()
+
+    def tell(self) -> float:
+        """Seconds into the file"""
+        with self.condition:
+            if self.paused:
+                return self.position
+            return time.perf_counter() - self.origin
+
+    def pause(self):
+        with self.condition:
+            if not self.paused:
+                self.position = time.perf_counter() - self.origin
+                self.paused = True
+                self._silence()
+                self.condition.notify()
+
+    def resume(self):
+        with self.condition:
+            if self.paused:
+                self.paused = False
+                self._start_at(self.position)
+
+    def seek(self, position: float):
+        with self.condition:
+            position = max(0.0, position)
+            if self.source is None:
+                # Only known to be past the end once everything was pulled
+                position = min(position, self.offsets[-1] if self.offsets else 0.0)
+            self._silence()
+            if self.paused:
+                self.position = position
+            else:
+                self._start_at(position)
+
+    def stop(self):
+        with self.condition:
+            self.stopped = True
+            self._silence()
+            self.condition.notify()
+        if self.playing:
+            self.thread.join()
+
+    def _start_at(self, position: float):
+        # Caller holds the condition
+        self.pending = deque(self.notes[bisect_left(self.offsets, position):])
+        self.origin = time.perf_counter() - position
+        self.position = position
+        self.condition.notify()
+
+    def _silence(self):
+        # Caller holds the condition
+        for pitch in self.sounding:
+            play_note(self.midi_output, pitch, 0)
+            self.events.append((128, pitch, 0))
+        self.sounding.clear()
+
+    def _pull(self):
+        # Outside the condition, the source may wait for the loader
+        chunk = next(self.source, None)
+        with self.condition:
+            if chunk is None:
+                self.source = None
+                return
+            notes = chunk.tolist()
+            if not self.notes and not self.paused:
+                # The clock starts once there is something to play, not while the file is still parsing
+                self.origin = time.perf_counter() - self.position
+            self.notes.extend(notes)
+            self.offsets.extend(note[0] for note in notes)
+            # Every pulled note comes after the rest, so pending stays a tail of notes,
+            # minus what a seek past the pulled notes skipped
+            self.pending.extend(note for note in notes if note[0] >= self.position)
+
+    def _send(self, status, pitch, velocity):
+        play_note(self.midi_output, pitch, velocity)
+        if status == 144:
+            self.sounding.add(pitch)
+        else:
+            self.sounding.discard(pitch)
+        self.events.append((status, pitch, velocity))
+
+    def _run(self):
+        while True:
+            with self.condition:
+                while self.paused and not self.stopped:
+                    self.condition.wait()
+                if self.stopped:
+                    return
+                pull = self.source is not None and (
+                    not self.offsets or self.offsets[-1] < time.perf_counter() - self.origin + self.LOOKAHEAD)
+                if not pull:
+                    if not self.pending:
+                        return
+                    head = self.pending[0]
+                    deadline = self.origin + head[0]
+                    remaining = deadline - time.perf_counter()
+                    if remaining > self.SPIN_TIME:
+                        # Wakes up early when paused, stopped or seeking
+                        self.condition.wait(remaining - self.SPIN_TIME)
+                        continue
+            if pull:
+                self._pull()
+                continue
+            while time.perf_counter() < deadline:
+                time.sleep(0)
+            with self.condition:
+                # Send everything due unless the schedule changed while spinning
+                if self.paused or self.stopped or not self.pending or self.pending[0] is not head:
+                    continue
+                now = time.perf_counter()
+                while self.pending and self.origin + self.pending[0][0] <= now:
+                    _, status, pitch, velocity = self.pending.popleft()
+                    self._send(status, pitch, velocity)
+
+def play_next(player: MidiPlayer, loader: MidiLoader, playlist: deque):
+    """Play the first file of the playlist and parse the one after it in the background"""
+    filename = playlist.popleft()
+    print("playing audio file: " + filename)
+    player.play(loader.stream(filename))
+    if playlist:
+        loader.prefetch(playlist[0])
+
+class NoteStore:
+    """Preallocated ring buffer of drawn notes, oldest first.
+
+    Notes are addressed by an ever-increasing sequence number; the slot of a
+    note is its sequence number masked by the (power of two) capacity.
+    Strokes index the sequence numbers of their notes so they can be undone
+    and redone without searching the whole buffer.
+    """
+
+    def __init__(self, capacity: int = 4096):
+        capacity = 1 << max(0, capacity - 1).bit_length()
+        self.notes = np.zeros(capacity, dtype=NOTE_DTYPE)
+        self.head = 0  # Sequence number of the oldest live note
+        self.tail = 0  # Sequence number the next note will get
+        self.strokes = {}  # Stroke -> sequence numbers of its notes, oldest stroke first
+        self.undone = []  # (stroke, sequence numbers) to redo, last undone last
+        self.next_stroke = 0
+
+    def __len__(self):
+        return self.tail - self.head
+
+    def new_stroke(self) -> int:
+        """Id for the notes of a new note on, forgets what could be redone"""
+        self.undone.clear()
+        self.next_stroke += 1
+        return self.next_stroke
+
+    def append(self, x, y, color_index, pitch, velocity, time_pressed, stroke=0):
+        if self.tail - self.head == len(self.notes):
+            self._grow()
+        self.notes[self.tail & (len(self.notes) - 1)] = (x, y, color_index, pitch, velocity, time_pressed, stroke, True)
+        if stroke in self.strokes:
+            self.strokes[stroke].append(self.tail)
+        else:
+            self.strokes[stroke] = [self.tail]
+        self.tail += 1
+
+    def _grow(self):
+        # Re-slot every live note into a buffer twice the size
+        sequence = np.arange(self.head, self.tail)
+        notes = np.zeros(len(self.notes) * 2, dtype=NOTE_DTYPE)
+        notes[sequence & (len(notes) - 1)] = self.notes[sequence & (len(self.notes) - 1)]
+        self.notes = notes
 
-def main():
+    def ordered(self) -> np.ndarray:
+        """Live notes oldest first; a view unless the ring has wrapped."""
+        return self._range(self.head, self.tail)
+
+    def _halves(self, start: int, end: int):
+        # Views of the notes from sequence number start up to end, split where the ring wraps
+        first = start & (len(self.notes) - 1)
+        last = first + end - start
+        return self.notes[first:min(last, len(self.notes))], self.notes[:max(0, last - len(self.notes))]
+
+    def _range(self, start: int, end: int) -> np.ndarray:
+        first, second = self._halves(start, end)
+        return np.concatenate((first, second)) if len(second) else first
+
+    def _leading_below(self, field: str, limit) -> int:
+        # Notes are appended in time order and scroll up together, so field only rises from head to tail
+        if not len(self) or self.notes[field][self.head & (len(self.notes) - 1)] >= limit:
+            return 0
+        first, second = self._halves(self.head, self.tail)
+        count = int(np.searchsorted(first[field], limit))
+        if count == len(first):
+            count += int(np.searchsorted(second[field], limit))
+        return count
+
+    def expire(self, cutoff: float) -> np.ndarray:
+        """Remove and return the leading notes pressed before the cutoff."""
+        return self.drop_head(self._leading_below("time", cutoff))
+
+    def drop_above(self, y: int) -> np.ndarray:
+        """Remove and return the leading notes that scrolled above y."""
+        return self.drop_head(self._leading_below("y", y))
+
+    def since(self, sequence: int) -> np.ndarray:
+        """Live notes appended at or after the given sequence number."""
+        return self._range(max(sequence, self.head), self.tail)
+
+    def drop_head(self, count: int) -> np.ndarray:
+        dropped = self._range(self.head, self.head + count).copy()
+        self.head += count
+        # Forget the oldest strokes once none of their notes are left
+        while self.strokes:
+            stroke, sequence = next(iter(self.strokes.items()))
+            if sequence[-1] >= self.head:
+                break
+            del self.strokes[stroke]
+        return dropped
+
+    def undo(self) -> np.ndarray:
+        """Hide the newest stroke that still has notes, returns its notes."""
+        while self.strokes:
+            stroke = next(reversed(self.strokes))
+            sequence = self.strokes.pop(stroke)
+            removed = self._set_alive(sequence, False)
+            if len(removed):
+                self.undone.append((stroke, sequence))
+                return removed
+        return self.notes[:0]
+
+    def redo(self) -> np.ndarray:
+        """Show the last undone stroke again, returns its notes."""
+        while self.undone:
+            stroke, sequence = self.undone.pop()
+            restored = self._set_alive(sequence, True)
+            if len(restored):
+                # A stroke undone while its key was held kept getting notes since
+                self.strokes[stroke] = sequence + self.strokes.get(stroke, [])
+                return restored
+        return self.notes[:0]
+
+    def _set_alive(self, sequence: list, alive: bool) -> np.ndarray:
+        # Notes of the stroke that have not been dropped yet
+        sequence = np.asarray(sequence[bisect_left(sequence, self.head):], dtype=np.int64)
+        slots = sequence & (len(self.notes) - 1)
+        self.notes["alive"][slots] = alive
+        return self.notes[slots]
+
+    def load(self, notes: np.ndarray):
+        """Replace everything with the notes, oldest first, in one copy"""
+        capacity = len(self.notes)
+        while capacity < len(notes):
+            capacity *= 2
+        self.notes = np.zeros(capacity, dtype=NOTE_DTYPE)
+        self.notes[:len(notes)] = notes
+        self.head = 0
+        self.tail = len(notes)
+        self.strokes.clear()
+        self.undone.clear()
+        for sequence, stroke in enumerate(notes["stroke"].tolist()):
+            if stroke in self.strokes:
+                self.strokes[stroke].append(sequence)
+            else:
+                self.strokes[stroke] = [sequence]
+        self.next_stroke = max(self.strokes, default=0)
+
+    def shift_y(self, dy: int):
+        # Dead slots shift too, they get overwritten before they are read again
+        self.notes["y"] += dy
+
+    def clear(self):
+        self.head = self.tail
+        self.strokes.clear()
+        self.undone.clear()
+
+class FrameProfiler:
+    """Times every stage of the main loop with perf_counter.
+
+    mark(stage) charges the time since the previous mark to that stage. The
+    last PROFILE_WINDOW frames are kept for percentiles, and every frame can
+    also be written as a row of a CSV file.
+    """
+
+    def __init__(self, window: int = PROFILE_WINDOW):
+        self.frames = deque(maxlen=window)
+        self.stages = {stage: deque(maxlen=window) for stage in PROFILE_STAGES}
+        self.latencies = deque(maxlen=window)
+        self.note_counts = deque(maxlen=window)
+        self.frame_starts = deque(maxlen=window)
+        self.stage_times = dict.fromkeys(PROFILE_STAGES, 0.0)
+        self.frame_latencies = []
+        self.frame_start = self.last_mark = time.perf_counter()
+        self.frame_count = 0
+        self.csv_file = None
+        self.csv_writer = None
+
+    def start_frame(self):
+        self.frame_start = self.last_mark = time.perf_counter()
+        for stage in self.stage_times:
+            self.stage_times[stage] = 0.0
+        self.frame_latencies.clear()
+
+    def mark(self, stage: str):
+        now = time.perf_counter()
+        self.stage_times[stage] += now - self.last_mark
+        self.last_mark = now
+
+    def note_shown(self, note_time: float):
+        """Call once a note played at note_time has reached the screen"""
+        self.frame_latencies.append(time.perf_counter() - note_time)
+
+    def end_frame(self, note_count: int, queue_depth: int):
+        frame_time = self.last_mark - self.frame_start
+        self.frames.append(frame_time)
+        self.frame_starts.append(self.frame_start)
+        self.note_counts.append(note_count)
+        for stage, stage_time in self.stage_times.items():
+            self.stages[stage].append(stage_time)
+        self.latencies.extend(self.frame_latencies)
+        self.frame_count += 1
+        if self.csv_writer is not None:
+            latency = max(self.frame_latencies) * 1000 if self.frame_latencies else ""
+            self.csv_writer.writerow([self.frame_count, f"{self.frame_start:.6f}", f"{frame_time * 1000:.3f}"]
+                                     + [f"{self.stage_times[stage] * 1000:.3f}" for stage in PROFILE_STAGES]
+                                     + [note_count, queue_depth, latency])
+
+    def start_csv(self, filename: str):
+        self.stop_csv()
+        self.csv_file = open(filename, "w", newline="")
+        self.csv_writer = csv.writer(self.csv_file)
+        self.csv_writer.writerow(["frame", "start", "frame_ms"] + [stage + "_ms" for stage in PROFILE_STAGES]
+                                 + ["notes", "queue_depth", "latency_ms"])
+
+    def stop_csv(self):
+        if self.csv_file is not None:
+            self.csv_file.close()
+            self.csv_file = self.csv_writer = None
+
+    def hud_lines(self, fps: float, note_count: int, queue_depth: int) -> list:
+        lines = [f"{fps:.0f} fps   frame p50 {percentile(self.frames, 50) * 1000:.1f} ms"
+                 f"   p99 {percentile(self.frames, 99) * 1000:.1f} ms",
+                 f"notes {note_count}   midi queue {queue_depth}"
+                 f"   note to pixel p50 {percentile(self.latencies, 50) * 1000:.1f} ms"
+                 f"   p99 {percentile(self.latencies, 99) * 1000:.1f} ms"]
+        lines += [f"{stage} {percentile(times, 50) * 1000:.2f} / {percentile(times, 99) * 1000:.2f} ms"
+                  for stage, times in self.stages.items()]
+        if self.csv_writer is not None:
+            lines.append("writing " + self.csv_file.name)
+        return lines
+
+def percentile(values, p: float) -> float:
+    if not values:
+        return 0.0
+    return float(np.percentile(np.fromiter(values, dtype=np.float64), p))
+
+def draw_hud(screen: pygame.Surface, font: pygame.font.Font, lines: list) -> pygame.Rect:
+    """Draw lines of text in the top left corner, returns the area drawn over"""
+    surfaces = [font.render(line, True, WHITE, BLACK) for line in lines]
+    hud_rect = pygame.Rect(0, 0, max(surface.get_width() for surface in surfaces),
+                           sum(surface.get_height() for surface in surfaces))
+    screen.blits([(surface, (0, sum(above.get_height() for above in surfaces[:i])))
+                  for i, surface in enumerate(surfaces)], doreturn=False)
+    return hud_rect
+
+class TiledLayer:
+    """A full screen layer that remembers which tiles have been painted on.
+
+    Clearing only puts the blank background back over those tiles.
+    """
+
+    def __init__(self, blank: pygame.Surface):
+        self.blank = blank
+        self.surface = blank.copy()
+        self.dirty = np.zeros((TILE_ROWS, TILE_COLUMNS), dtype=bool)
+
+    @staticmethod
+    def tiles_of(notes: np.ndarray) -> np.ndarray:
+        """Tiles the circles of the notes touch"""
+        tiles = np.zeros((TILE_ROWS, TILE_COLUMNS), dtype=bool)
+        radii = note_radii(notes) + 1
+        left = ((notes["x"] - radii) // TILE_WIDTH).clip(0, TILE_COLUMNS - 1)
+        right = ((notes["x"] + radii) // TILE_WIDTH).clip(0, TILE_COLUMNS - 1)
+        top = ((notes["y"] - radii) // TILE_HEIGHT).clip(0, TILE_ROWS - 1)
+        bottom = ((notes["y"] + radii) // TILE_HEIGHT).clip(0, TILE_ROWS - 1)
+        for corners in set(zip(left.tolist(), right.tolist(), top.tolist(), bottom.tolist())):
+            tiles[corners[2]:corners[3] + 1, corners[0]:corners[1] + 1] = True
+        return tiles
+
+    def mark(self, notes: np.ndarray):
+        self.dirty |= self.tiles_of(notes)
+
+    def clear(self) -> list:
+        """Blank every painted tile, returns their rects"""
+        rects = tile_rects(self.dirty)
+        for rect in rects:
+            self.surface.blit(self.blank, rect, rect)
+        self.dirty[:] = False
+        return rects
+
+def tile_rects(tiles: np.ndarray) -> list:
+    return [pygame.Rect(column * TILE_WIDTH, row * TILE_HEIGHT, TILE_WIDTH, TILE_HEIGHT).clip(FULL_SCREEN)
+            for row, column in zip(*np.nonzero(tiles))]
+
+def redraw_tiles(canvas: TiledLayer, paint: TiledLayer, notes: np.ndarray, tiles: np.ndarray, time_pressed: float,
+                 gradients: bool, scrolling: bool, sprites: "SpriteCache") -> list:
+    """Composite the paint layer and the notes again inside the tiles, returns their rects"""
+    rects = tile_rects(tiles)
+    radii = note_radii(notes) + 1
+    for rect in rects:
+        overlapping = ((notes["x"] + radii > rect.left) & (notes["x"] - radii < rect.right) &
+                       (notes["y"] + radii > rect.top) & (notes["y"] - radii < rect.bottom))
+        canvas.surface.set_clip(rect)
+        canvas.surface.blit(paint.surface, rect, rect)
+        draw_notes(canvas.surface, notes[overlapping], time_pressed, gradients, scrolling, sprites)
+    canvas.surface.set_clip(None)
+    return rects
+
+class QualityGovernor:
+    """Lowers drawing quality while frames take longer than the budget.
+
+    Keeps an average of the work time of each frame (not counting the sleep in
+    clock.tick). Quality drops a level when the average comes close to the
+    budget and comes back a level at a time once there is plenty of headroom.
+    """
+
+    DOWN_FRAMES = 30  # Frames to wait between dropping levels
+    UP_FRAMES = 180  # Frames of headroom needed to come back a level
+
+    def __init__(self, budget: float = FRAME_BUDGET):
+        self.budget = budget
+        self.level = QUALITY_FULL
+        self.average = 0.0
+        self.frames_since_change = 0
+
+    def update(self, work_time: float) -> bool:
+        """Call once a frame, returns whether the level changed"""
+        self.average += (work_time - self.average) * .1
+        self.frames_since_change += 1
+        if (self.average > self.budget * .9 and self.level < QUALITY_MERGED_DOTS and
+                self.frames_since_change >= self.DOWN_FRAMES):
+            self.level += 1
+        elif (self.average < self.budget * .5 and self.level > QUALITY_FULL and
+                self.frames_since_change >= self.UP_FRAMES):
+            self.level -= 1
+        else:
+            return False
+        self.frames_since_change = 0
+        return True
+
+def main(auto_color: bool = True, scrolling: bool = False, gradients: bool = False, dirty_rects: bool = True,
+         callback_input: bool = True, fps: int = 60, profiler: "FrameProfiler" = None,
+         session: str = "session.snapshot", input_ports=None):
+    """DEV-ONLY OPTIONS:
+
+    dirty_rects: Only update the changed parts of the screen
+    callback_input: Play notes from rtmidi's thread instead of once per frame
+    fps: Frame rate cap, 0 runs as fast as possible
+    profiler: Collects the frame times, a new one by default
+    session: Snapshot the painting is resumed from and autosaved to, None to start fresh every time
+    input_ports: MIDI inputs to open by index or part of their name, None for the second-to-last one
+    """
     pygame.init()
     screen = pygame.display.set_mode(DIMENSIONS)
     pygame.display.set_caption("MIDI Visualizer with Persistent Notes")
 
-    midi_in = rtmidi.MidiIn()
+    if rtmidi is None:
+        print("MIDI input needs python-rtmidi, which could not be loaded.")
+        return
     midi_output = setup_midi_output()
-    available_ports = midi_in.get_ports()
+    available_ports = rtmidi.MidiIn().get_ports()
 
     if not available_ports:
         print("No MIDI devices connected.")
         return
 
-    # Open the second-to-last connected device
-    # Novation LaunchKey 49 connects as 2 MIDI devices, so we use the first one
-    latest_device_index = len(available_ports) - 2
-    midi_in.open_port(latest_device_index)
-    print(f"Connected to device: {available_ports[latest_device_index]}")
+    if input_ports is None:
+        # Open the second-to-last connected device
+        # Novation LaunchKey 49 connects as 2 MIDI devices, so we use the first one
+        input_ports = [len(available_ports) - 2]
+    inputs = MidiInputs(midi_output, callback_input)
+    for index in find_input_ports(available_ports, input_ports):
+        inputs.open(index, available_ports[index])
+    if not inputs.ports:
+        return
 
-    # List to keep track of drawn notes as persistent "trails"
-    drawn_notes = [] # List
+    # Ring buffer to keep track of drawn notes as persistent "trails"
+    drawn_notes = NoteStore()
+    # Keyed by (port, pitch) so performers on different ports can hold the same pitch
     held_notes = {} # Set
+    held_strokes = {} # Stroke of every held note
 
     color_index = 0
-    draw_background(screen)
-    background_image = screen.copy()
+    blank = pygame.Surface(DIMENSIONS)
+    draw_background(blank)
+    # Notes baked in once they expire
+    paint = TiledLayer(blank)
+    # Paint plus every live note, so the screen can be restored piece by piece
+    # The marker, held notes and hints are drawn over it straight onto the screen
+    canvas = TiledLayer(blank)
+    sprites = SpriteCache()
 
     clock = pygame.time.Clock()
     max_height = radius_from_velocity(128) * 2
@@ -77,44 +1076,84 @@ def main():
     last_loop_time = time.time()
     current_time = 0
 
-    # DEV-ONLY OPTIONS:
-    auto_color = True
-    scrolling = False
-    gradients = False
     
     take_screenshot = False
-    recording = False
-    playing = False
-    paused = False
-    midi_messages = []
-    midi_file = None
-    next_note_time = time.perf_counter()
-    play_filename = "recorded_output.mid"
+    numbered_screenshots = True # Keep every screenshot instead of overwriting screenshot.png
+    screenshot_number = next_file_number("screenshot_", ".png")
+    file_writer = FileWriter()
+    last_autosave = time.perf_counter()
+    if session and os.path.exists(session):
+        try:
+            pixels, size, notes, state = read_snapshot(session)
+            paint.surface.blit(pygame.image.frombuffer(pixels, size, "RGB"), (0, 0))
+            paint.dirty[:] = True
+            notes = notes.copy()
+            notes["time"] += time.perf_counter()
+            drawn_notes.load(notes)
+            color_index = state["color_index"]
+            current_time = state["current_time"]
+            last_loop_time = int(current_time / TIME_LOOP)
+            print(f"resumed {session} with {len(notes)} notes")
+        except (OSError, ValueError, KeyError) as error:
+            print(f"could not resume {session}: {error}")
+    recorder = Recorder(file_writer)
+    recover_journals(file_writer)
+    loader = MidiLoader()
+    player = MidiPlayer(midi_output)
+    playlist = deque()  # Files still to play after the current one
 
     run_program = True
+    playing = False
+    full_redraw = True
+    previous_dirty = []
+    pending_dirty = []  # Canvas rects changed outside of the drawing stage
+    repair_tiles = np.zeros((TILE_ROWS, TILE_COLUMNS), dtype=bool)  # Tiles notes were taken out of or put back in
+
+    if profiler is None:
+        profiler = FrameProfiler()
+    show_hud = False
+    governor = QualityGovernor()
+    last_frame_start = time.perf_counter()
+    scroll_offset = 0.0
+    dot_time = 0.0  # Time since the last dot, less than FRAME_BUDGET
+    merge_frame = False
+    merged_stroke = 0
+    hud_font = pygame.font.Font(None, 24)
 
     try:
         while run_program:
+            profiler.start_frame()
             # print(str(len(drawn_notes)))
-            # current_time = time.time() - start_time
+            # Time follows the clock, however long the last frame took
+            frame_start = time.perf_counter()
+            elapsed = frame_start - last_frame_start
+            last_frame_start = frame_start
+            previous_time = current_time
             if (not pause_time):
-                current_time += 1/60
+                current_time += elapsed
+            if (up_time):
+                current_time -= 8 * elapsed
+            elif (down_time):
+                current_time += 6 * elapsed
             looped_time = current_time % TIME_LOOP  # Wrap time into an 8-second loop
             time_to_reset = int(current_time / TIME_LOOP)  # Detect loop reset for color change
+            use_gradients = gradients and governor.level < QUALITY_FLAT_COLORS
 
             # Change the color every time the loop resets (every 8 seconds)
             if time_to_reset != last_loop_time:
                 last_loop_time = time_to_reset
                 if(auto_color):
                     color_index = (color_index + 1) % len(NOTE_COLORS)
-                midi_output.note_off(43)
-                midi_output.note_off(88)
+                play_note(midi_output, 43, 0)
+                play_note(midi_output, 88, 0)
 
             # COMMANDS
             for event in pygame.event.get():
                 # End Program
                 if event.type == pygame.QUIT:
                     run_program = False
+                elif event.type == pygame.WINDOWEXPOSED:
+                    full_redraw = True
                 elif event.type == pygame.KEYDOWN:
                     # Change Color
                     if event.key == pygame.K_SPACE:
@@ -123,9 +1162,9 @@ def main():
                         play_special_note(midi_output, 88)
                     # Clear Screen
                     elif event.key == pygame.K_e:
-                        drawn_notes = []
-                        draw_background(screen)
-                        background_image = screen.copy()
+                        drawn_notes.clear()
+                        paint.clear()
+                        pending_dirty += canvas.clear()
                         play_special_note(midi_output, 43, 100)
                     # Pause Movement
                     elif event.key == pygame.K_LSHIFT:
@@ -139,46 +1178,52 @@ def main():
                         down_time = True
                     # Undo Button
                     elif event.key == pygame.K_z:
-                        if (len(drawn_notes) != 0):
-                            note_removed = drawn_notes.pop()
-                            # iterate backwards to find all notes that have
-                            # the same pitch and close to the same time
-                            i = len(drawn_notes) -1
-                            while i > -1:
-                                note = drawn_notes[i]
-                                if (note[3] == note_removed[3] and note[2] == note_removed[2] and
-                                    (note[1] + 6 > note_removed[1] and note[1] - 6 < note_removed[1])):
-                                    note_removed = drawn_notes.pop(i)
-                                i -= 1
+                        repair_tiles |= canvas.tiles_of(drawn_notes.undo())
+                    # Redo Button
+                    elif event.key == pygame.K_x:
+                        repair_tiles |= canvas.tiles_of(drawn_notes.redo())
                     # (R)ecord MIDI Button
-                    elif event.key == pygame.K_r and not playing:
-                        recording = not recording
-                        print("Pressed recording to " + str(recording))
+                    elif event.key == pygame.K_r and not player.playing:
+                        if recorder.recording:
+                            recorder.stop()
+                        else:
+                            recorder.start(time.strftime("recorded_output_%Y%m%d_%H%M%S.mid"))
+                        print("Pressed recording to " + str(recorder.recording))
                     # (P)lay MIDI Button
                     # Cannot record and play at same time
-                    elif event.key == pygame.K_p and not recording:
-                        if not playing:
-                            print("playing audio file: " + play_filename)
-                            playing = True
-                            midi_messages = []
-                            midi_file = MidiFile(play_filename)
-                            # Outputs note messages only by default
-                            for message in midi_file:
-                                midi_messages.append(message)
-                            # Start playing right NOW
-                            next_note_time = time.perf_counter() # + midi_messages[0].time
-                        else:
-                            if paused:
-                                paused = False
-                                next_note_time = time.perf_counter()
+                    elif event.key == pygame.K_p and not recorder.recording:
+                        if not player.playing:
+                            playlist = deque(sorted(glob.glob(PLAYLIST_PATTERN)))
+                            if playlist:
+                                # Start playing right NOW, the file streams in while it plays
+                                play_next(player, loader, playlist)
                             else:
-                                paused = True
+                                print("nothing to play matches " + PLAYLIST_PATTERN)
+                        elif player.paused:
+                            player.resume()
+                        else:
+                            player.pause()
+                    # Skip back and forth through the playing file
+                    elif event.key == pygame.K_LEFT and player.playing:
+                        player.seek(player.tell() - SEEK_STEP)
+                    elif event.key == pygame.K_RIGHT and player.playing:
+                        player.seek(player.tell() + SEEK_STEP)
                     # (Q)uit
                     elif event.key == pygame.K_q:
                         run_program = False
                     # (T)ake Screenshot
                     elif event.key == pygame.K_t:
                         take_screenshot = True
+                    # (H)eads-up display of the frame profiler
+                    elif event.key == pygame.K_h:
+                        show_hud = not show_hud
+                    # Write every frame's profile to a (C)SV file
+                    elif event.key == pygame.K_c:
+                        if profiler.csv_file is None:
+                            profiler.start_csv(f"profile_{next_file_number('profile_', '.csv'):04d}.csv")
+                            print("profiling to " + profiler.csv_file.name)
+                        else:
+                            profiler.stop_csv()
                 elif event.type == pygame.KEYUP:
                     if event.key == pygame.K_LSHIFT:
                         pause_time = False
@@ -188,154 +1233,143 @@ def main():
                     if event.key == pygame.K_s:
                         down_time = False
 
+            profiler.mark("events")
+
             # Process all incoming MIDI messages
-            while True:
-                if (up_time):
-                    current_time -= 8/60
-                elif (down_time):
-                    current_time += 6/60
-                if (not recording and len(midi_messages) > 0 and not playing):
-                    # Save to a MIDI File
-                    print("beginning save with " + str(len(midi_messages)))
-                    midi_file = MidiFile()
-                    track = MidiTrack()
-                    # track.append(MetaMessage('set_tempo', tempo=500000)) #supposedly 120 BPM
-                    midi_file.tracks.append(track)
-                    for msg in midi_messages:
-                        track.append(msg)
-
-                    #Write to given filename
-                    output_filename = "recorded_output" + str(int(time.time()%10000)) + ".mid"
-                    midi_file.save(output_filename)
-                    midi_messages = []
-                    print("saved")
-                
-                # Accept input from the user
-                msg = midi_in.get_message()
-                if not msg:
-                    # Play from the recorded midi file if the user has not played that very millisecond
-                    if (playing and not paused):
-                        # Things will generally be played on time, but not exactly when the user is playing too
-                        if next_note_time <= time.perf_counter():
-                            if not isinstance(midi_messages[0],MetaMessage):
-                                if midi_messages[0].velocity != 0:
-                                    # Construct message that can be read
-                                    message = (144, midi_messages[0].note, midi_messages[0].velocity)
-                                    msg = (message, midi_messages[0].time)
-                                else:
-                                    message = (128, midi_messages[0].note, 0)
-                                    msg = (message, midi_messages[0].time)
-                            if len(midi_messages) != 0:
-                                midi_messages = midi_messages[1:]
-                                if len(midi_messages) != 0:
-                                    next_note_time += midi_messages[0].time
-                        if len(midi_messages) == 0:
-                            playing = False
-                            print("playing finished")
-                if not msg:
-                    break
+            queue_depth = inputs.pending + len(player.events)
+            shown_notes = []
+            # Accept input from the user, already played on arrival
+            # Every port's messages merged in the order they came in
+            for status, pitch, velocity, input_time, port in inputs.drain():
+                if callback_input and status == 144 and velocity > 0:
+                    shown_notes.append(input_time)
+
+                # Record MIDI input on the port's channel
+                if (recorder.recording):
+                    recorder.record((status | inputs.channel(port), pitch, velocity), input_time)
+
+                # Save the velocity of held notes, drawn_notes gets them every frame
+                update_held_notes(held_notes, status, (port, pitch), velocity)
+                if status == 144 and velocity > 0:
+                    held_strokes[port, pitch] = drawn_notes.new_stroke()
+
+            if recorder.recording:
+                recorder.flush_due(time.perf_counter())
+            if session and time.perf_counter() - last_autosave >= AUTOSAVE_TIME:
+                save_session(file_writer, session, paint, drawn_notes, session_state(color_index, current_time))
+                last_autosave = time.perf_counter()
+
+            # Report saves the file writer finished since last frame
+            while file_writer.finished:
+                filename, error = file_writer.finished.popleft()
+                if error is None:
+                    print("saved " + filename)
                 else:
-                    message, delta_time = msg
-                    status, pitch, velocity = message
-
-                    # Record MIDI input
-                    if (recording):
-                        print(len(midi_messages))
-                        mido_message = Message.from_bytes(message)
-                        mido_message.time = int(delta_time * 1000)
-                        midi_messages.append(mido_message)
-                        print(mido_message)
-
-                    # Play or stop the note based on Note On/Off status
-                    if status == 144 and velocity > 0:  # Note On)
-                        play_note(midi_output, pitch, velocity)
-                        # Calculate x and y for the note based on pitch and time
-                        # Save position, color index, and pitch to drawn_notes list (for persistent notes)
-                        held_notes[pitch] = velocity
-                    elif status == 128:# or (status == 144 and velocity == 0):  # Note Off
-                        play_note(midi_output, pitch, 0)
-                        
-                        if pitch in held_notes:
-                            held_notes.pop(pitch)
-                        # No removal of notes, only updating color on loop reset
-
-            # Clear and update the screen with the known background image
-            # Only update around the marker line up to the height of the largest possible circle
+                    print(f"could not save {filename}: {error}")
+            while loader.failed:
+                filename, error = loader.failed.popleft()
+                print(f"could not load {filename}: {error}")
+
+            # Draw what the player has sent out since last frame
+            while player.events:
+                status, pitch, velocity = player.events.popleft()
+                # Played files draw like the first port
+                update_held_notes(held_notes, status, (0, pitch), velocity)
+                if status == 144 and velocity > 0:
+                    held_strokes[0, pitch] = drawn_notes.new_stroke()
+            if playing and not player.playing:
+                print("playing finished")
+                if playlist and not recorder.recording:
+                    play_next(player, loader, playlist)
+            playing = player.playing
+
+            profiler.mark("midi")
+
             time_marker_y = int((looped_time / TIME_LOOP) * SCREEN_HEIGHT)
-            screen.blit(background_image, FULL_SCREEN, FULL_SCREEN)
+
+            # One dot and one decay per held note for every whole 60th of a second that went by,
+            # spread out along the stroke between last frame's marker and this one
+            dot_time += elapsed
+            steps = int(dot_time / FRAME_BUDGET)
+            dot_time -= steps * FRAME_BUDGET
+            # What a stall goes past the cap is dropped instead of catching up later
+            steps = min(MAX_FRAME_STEPS, steps)
+            add_dots = True
+            merge_dots = governor.level >= QUALITY_MERGED_DOTS
+            if merge_dots and steps:
+                # New strokes still get their first dot right away
+                add_dots = merge_frame or drawn_notes.next_stroke != merged_stroke
+                merge_frame = not merge_frame
+                merged_stroke = drawn_notes.next_stroke
+            scroll_step = SCROLL_SPEED * elapsed / max(1, steps)
 
             if(scrolling):
                 time_marker_y = int(SCREEN_HEIGHT - (LINE_WIDTH * 4))
-                i = len(drawn_notes) -1
-                while i > -1:
-                    note = drawn_notes[i]
-                    if (note[1] < -max_height):
-                        drawn_notes.pop(i)
-                    else:
-                        list_note = list(note)
-                        list_note[1] -= 2
-                        drawn_notes[i] = tuple(list_note)
-                    i -= 1
+                scroll_offset += SCROLL_SPEED * elapsed
+                drawn_notes.shift_y(-int(scroll_offset))
+                scroll_offset -= int(scroll_offset)
+                drawn_notes.drop_above(-max_height)
 
             # Add all held notes to the drawn notes at the y-level in which they are pressed
             time_pressed = time.perf_counter()
-            for pitch in held_notes:
-                x = int(((pitch - PITCH_MIN) / (PITCH_MAX - PITCH_MIN)) * SCREEN_WIDTH)
-                if held_notes.get(pitch) > 1:
-                    drawn_notes.append((x, time_marker_y, color_index, pitch, held_notes.get(pitch), time_pressed))
-
-
-            # Draw all notes that are OVER 30 seconds old
-            first_expired_index = -1
-            for i in range(len(drawn_notes)):
-                x, y, one_color_index, pitch, velocity, time_to_reset = drawn_notes[i]
-            # for x, y, one_color_index, pitch, velocity, time_to_reset in drawn_notes:
-                # if note is 30 seconds old, get rid of 
-                if time_pressed > time_to_reset + 30:
-                    first_expired_index += 1
+            first_new_note = drawn_notes.tail
+            for step in range(steps):
+                steps_left = steps - 1 - step
+                if scrolling:
+                    step_y = time_marker_y - int(scroll_step * steps_left)
                 else:
-                    break
-                color = NOTE_COLORS[one_color_index]  # Get color based on the color index
-                if (gradients):
-                    if (scrolling):
-                        b=.3
-                        drawn_time = (SCREEN_HEIGHT/2) - y
-                    else:
-                        b=7
-                        drawn_time = - (time_pressed - time_to_reset)
-                    new_color = list(color)
-                    for i in range(3):
-                        new_color[i] = min(255,max(0,color[i] + (b*drawn_time)))
-                        # print(new_color)
-                    color = tuple(new_color)
-                pygame.draw.circle(screen, color, (x, y), radius_from_velocity(velocity))
-
-            # Remove all notes that are OLDER than 30 seconds and replace with a photo
-            if (first_expired_index > -1):
-                # Update the whole screen just once
-                background_image = screen.copy()
-                drawn_notes = drawn_notes[first_expired_index:]
-
-            for x, y, one_color_index, pitch, velocity, time_to_reset in drawn_notes:
-                color = NOTE_COLORS[one_color_index]  # Get color based on the color index
-                if (gradients):
-                    if (scrolling):
-                        b=.3
-                        drawn_time = (SCREEN_HEIGHT/2) - y
-                    else:
-                        b=7
-                        drawn_time = - (time_pressed - time_to_reset)
-                    new_color = list(color)
-                    for i in range(3):
-                        new_color[i] = min(255,max(0,color[i] + (b*drawn_time)))
-                        # print(new_color)
-                    color = tuple(new_color)
-                pygame.draw.circle(screen, color, (x, y), radius_from_velocity(velocity))
+                    step_time = previous_time + (current_time - previous_time) * (step + 1) / steps
+                    step_y = int(((step_time % TIME_LOOP) / TIME_LOOP) * SCREEN_HEIGHT)
+                step_pressed = time_pressed - elapsed * steps_left / steps
+                # Merged dots only get the last dot of the frame
+                step_dots = add_dots and (steps_left == 0 or not merge_dots)
+                for note in held_notes:
+                    port, pitch = note
+                    x = PITCH_X_LUT[pitch]
+                    if held_notes.get(note) > 1 and step_dots:
+                        drawn_notes.append(x, step_y, (color_index + port) % len(NOTE_COLORS),
+                                           pitch, held_notes.get(note), step_pressed, held_strokes.get(note, 0))
+                    # Decrease the pitch over time
+                    held_notes[note] = decay_velocity(held_notes[note])
+
+            # Bake all notes that are OVER 30 seconds old into the background and remove them
+            expired_notes = drawn_notes.expire(time_pressed - NOTE_LIFETIME)
+            draw_notes(paint.surface, expired_notes, time_pressed, use_gradients, scrolling, sprites)
+            paint.mark(expired_notes)
+
+            profiler.mark("notes")
+
+            # Every note moves or changes color when scrolling or fading, so redraw everything
+            if full_redraw or scrolling or use_gradients or not dirty_rects:
+                canvas.surface.blit(paint.surface, FULL_SCREEN, FULL_SCREEN)
+                draw_notes(canvas.surface, drawn_notes.ordered(), time_pressed, use_gradients, scrolling, sprites)
+                canvas.dirty[:] = True
+                screen.blit(canvas.surface, FULL_SCREEN, FULL_SCREEN)
+                dirty = None
+            else:
+                # Only restore what was drawn over last frame plus what changed since
+                new_notes = drawn_notes.since(first_new_note)
+                draw_notes(canvas.surface, new_notes, time_pressed, use_gradients, scrolling, sprites)
+                canvas.mark(new_notes)
+                dirty = previous_dirty + pending_dirty + note_rects(new_notes)
+                if repair_tiles.any():
+                    dirty += redraw_tiles(canvas, paint, drawn_notes.ordered(), repair_tiles,
+                                          time_pressed, use_gradients, scrolling, sprites)
+                for rect in dirty:
+                    screen.blit(canvas.surface, rect, rect)
+            pending_dirty = []
+            repair_tiles[:] = False
 
             if take_screenshot:
-                pygame.image.save(screen,"screenshot.png")
+                if numbered_screenshots:
+                    file_writer.save_image(screen, f"screenshot_{screenshot_number:04d}.png")
+                    screenshot_number += 1
+                else:
+                    file_writer.save_image(screen, "screenshot.png")
                 take_screenshot = False
 
+            profiler.mark("draw")
+
             # Draw the time marker line
             if time_marker_y < SCREEN_HEIGHT -2:
                 color = NOTE_COLORS[color_index]
@@ -355,30 +1389,26 @@ def main():
             multiplier = 1
             if scrolling:
                 multiplier = 2
-            # Outline all held notes (blends them together)
-            for pitch in held_notes:
-                x = int(((pitch - PITCH_MIN) / (PITCH_MAX - PITCH_MIN)) * SCREEN_WIDTH)
-                # draw outline only for currently held notes on the marker line
-                draw_circle_to_rect_gradient(screen, WHITE, (x, time_marker_y), radius_from_velocity(held_notes.get(pitch)) * multiplier, True)
-            for pitch in held_notes:
-                x = int(((pitch - PITCH_MIN) / (PITCH_MAX - PITCH_MIN)) * SCREEN_WIDTH)
+            profiler.mark("marker")
+            outlines = []
+            fills = []
+            keys = []
+            for (port, pitch), velocity in held_notes.items():
+                x = PITCH_X_LUT[pitch]
+                radius = RADIUS_LUT[velocity_index(velocity)]
+                color = NOTE_COLORS[(color_index + port) % len(NOTE_COLORS)]
+                key_color = (max(0,color[0]-50),max(0,color[1]-50),max(0,color[2]-50))
+                # Outline all held notes (blends them together)
+                if governor.level < QUALITY_NO_OUTLINES:
+                    sprite, offset = sprites.get(WHITE, int(radius * multiplier), "key_outline")
+                    outlines.append((sprite, (x - offset, time_marker_y - offset)))
                 # draws color over outline for currently held notes on the marker line
-                color = NOTE_COLORS[one_color_index]
-                draw_circle_to_rect_gradient(screen, color, (x, y), (radius_from_velocity(held_notes.get(pitch)) - LINE_WIDTH) * multiplier)
-
-            # Draw held notes as darkened key notes
-            for pitch in held_notes:
-                x = int(((pitch - PITCH_MIN) / (PITCH_MAX - PITCH_MIN)) * SCREEN_WIDTH)
-                color = (NOTE_COLORS[one_color_index])
-                color = (max(0,color[0]-50),max(0,color[1]-50),max(0,color[2]-50))
-                pygame.draw.rect(screen, color, ((x - (KEY_WIDTH), time_marker_y - (LINE_WIDTH*3)),(KEY_WIDTH*2 + LINE_WIDTH//2, (LINE_WIDTH * 6))),
-                                border_radius=KEY_BORDER_RADIUS)
-
-                # Decrease the pitch over time
-                velocity = held_notes.get(pitch)
-                # held_notes.update({pitch: max(0, (velocity -.1 - 10000/max(1,pow(velocity,3))))})
-                # held_notes.update({pitch: max(0, velocity*.9933 - (4/max(1,velocity)))})
-                held_notes.update({pitch: max(0, velocity*.997 - (4.5/max(1,velocity)))})
+                sprite, offset = sprites.get(color, int((radius - LINE_WIDTH) * multiplier), "key")
+                fills.append((sprite, (x - offset, time_marker_y - offset)))
+                # Draw held notes as darkened key notes
+                sprite, offset = sprites.get(key_color, 0, "key_cap")
+                keys.append((sprite, (x - offset, time_marker_y - offset)))
+            screen.blits(outlines + fills + keys, doreturn=False)
 
 
             # Draw the hint for the next colors at the end of it
@@ -387,15 +1417,49 @@ def main():
             pygame.draw.circle(screen, NOTE_COLORS[(color_index + 1)%len(NOTE_COLORS)], (SCREEN_WIDTH - (hint* 1.05), time_marker_y), hint * .72)
             pygame.draw.circle(screen, NOTE_COLORS[(color_index)], (SCREEN_WIDTH - (hint* 2.15), time_marker_y), hint)
 
+            # Everything drawn over the canvas lives around the marker line
+            # up to the height of the largest possible circle
+            overlay_height = int(max_height * multiplier)
+            overlay_rect = pygame.Rect(0, time_marker_y - overlay_height // 2 - LINE_WIDTH,
+                                       SCREEN_WIDTH, overlay_height + LINE_WIDTH * 2).clip(FULL_SCREEN)
+
+            profiler.mark("held")
+            overlay_rects = [overlay_rect]
+            if show_hud:
+                overlay_rects.append(draw_hud(screen, hud_font, profiler.hud_lines(
+                    clock.get_fps(), len(drawn_notes), queue_depth) + [f"quality level {governor.level}"]))
+            profiler.mark("hud")
+
             # flip to newly drawn display
-            pygame.display.flip()
-            clock.tick(60)
+            if dirty is None:
+                pygame.display.flip()
+            else:
+                pygame.display.update(dirty + overlay_rects)
+            for note_time in shown_notes:
+                profiler.note_shown(note_time)
+            previous_dirty = overlay_rects
+            full_redraw = False
+            profiler.mark("display")
+            if governor.update(time.perf_counter() - profiler.frame_start):
+                # Gradients may have been switched on or off
+                full_redraw = True
+            clock.tick(fps)
+            profiler.mark("tick")
+            profiler.end_frame(len(drawn_notes), queue_depth)
 
     except KeyboardInterrupt:
         print("Exiting.")
 
     finally:
-        midi_in.close_port()
+        player.stop()
+        loader.close()
+        if recorder.recording:
+            recorder.stop()
+        if session:
+            save_session(file_writer, session, paint, drawn_notes, session_state(color_index, current_time))
+        file_writer.close()
+        profiler.stop_csv()
+        inputs.close()
         midi_output.close()
         pygame.midi.quit()
         pygame.quit()
@@ -408,6 +1472,56 @@ def radius_from_velocity(v):
     return (pow(v-40,3)/9600) + (.416*v) + 7
     # return v*v//127
 
+RADIUS_LUT = np.array([radius_from_velocity(v) for v in range(128)])
+CIRCLE_RADIUS_LUT = RADIUS_LUT.astype(np.int32)
+PITCH_X_LUT = [int(((pitch - PITCH_MIN) / (PITCH_MAX - PITCH_MIN)) * SCREEN_WIDTH) for pitch in range(128)]
+
+def note_radii(notes: np.ndarray) -> np.ndarray:
+    """Radius of the circle draw_notes draws for every note"""
+    return CIRCLE_RADIUS_LUT[notes["velocity"].astype(np.int32).clip(0, 127)]
+
+def velocity_index(velocity) -> int:
+    """Clamp a (possibly decayed) velocity into the lookup tables"""
+    return min(127, max(0, int(velocity)))
+
+NOTE_COLOR_ARRAY = np.array(NOTE_COLORS, dtype=np.float64)
+
+def note_colors(notes: np.ndarray, time_pressed: float, scrolling: bool) -> np.ndarray:
+    """Gradient colors of every note, one RGB row each"""
+    if (scrolling):
+        b=.3
+        drawn_time = (SCREEN_HEIGHT/2) - notes["y"]
+    else:
+        b=7
+        drawn_time = - (time_pressed - notes["time"])
+    colors = NOTE_COLOR_ARRAY[notes["color_index"]] + (b*drawn_time)[:, np.newaxis]
+    return colors.clip(0, 255).astype(np.uint8)
+
+def draw_notes(screen: pygame.Surface, notes: np.ndarray, time_pressed: float, gradients: bool, scrolling: bool,
+               sprites: "SpriteCache"):
+    notes = notes[notes["alive"]]
+    radii = note_radii(notes)
+    if (gradients):
+        # Nearly every note has a color of its own that changes every few frames,
+        # sprites would be thrown away before they could be reused
+        colors = note_colors(notes, time_pressed, scrolling).tolist()
+        for x, y, color, radius in zip(notes["x"].tolist(), notes["y"].tolist(), colors, radii.tolist()):
+            pygame.draw.circle(screen, color, (x, y), radius)
+        return
+    # Get color based on the color index
+    colors = map(NOTE_COLORS.__getitem__, notes["color_index"].tolist())
+    blits = []
+    for x, y, color, radius in zip(notes["x"].tolist(), notes["y"].tolist(), colors, radii.tolist()):
+        sprite, offset = sprites.get(color, radius, "circle")
+        blits.append((sprite, (x - offset, y - offset)))
+    screen.blits(blits, doreturn=False)
+
+def note_rects(notes: np.ndarray) -> list:
+    """Bounding rects of the circles draw_notes would draw"""
+    radii = note_radii(notes) + 1
+    return [pygame.Rect(x - r, y - r, r * 2, r * 2)
+            for x, y, r in zip(notes["x"].tolist(), notes["y"].tolist(), radii.tolist())]
+
 def draw_background(screen: pygame.Surface):
     pygame.draw.rect(screen, SKY, FULL_SCREEN)
     # pygame.draw.rect(screen, BLACK, FULL_SCREEN)
@@ -430,5 +1544,50 @@ def draw_circle_to_rect_gradient(surface: pygame.Surface, color, center, radius:
     else:
         pygame.draw.circle(surface, color, center, radius)
 
+class SpriteCache:
+    """Pre-rendered note circles and key shapes, least recently used dropped first.
+
+    Sprites are square and centered, get() returns the sprite together with the
+    offset from its top left corner to the center.
+    """
+
+    def __init__(self, size: int = SPRITE_CACHE_SIZE):
+        self.size = size
+        self.sprites = OrderedDict()
+
+    def get(self, color, radius: int, kind: str = "circle"):
+        key = (color, radius, kind)
+        sprite = self.sprites.get(key)
+        if sprite is None:
+            sprite = self.sprites[key] = self.render(color, radius, kind)
+            if len(self.sprites) > self.size:
+                self.sprites.popitem(last=False)
+        else:
+            self.sprites.move_to_end(key)
+        return sprite
+
+    @staticmethod
+    def render(color, radius: int, kind: str):
+        if kind == "circle":
+            offset = max(0, radius) + 1
+        elif kind == "key_cap":
+            offset = int(KEY_WIDTH) + LINE_WIDTH
+        else:
+            offset = max(radius, KEY_BORDER_RADIUS * 3) + 1
+        sprite = pygame.Surface((offset * 2, offset * 2))
+        colorkey = COLORKEYS[tuple(color) == COLORKEYS[0]]
+        sprite.fill(colorkey)
+        sprite.set_colorkey(colorkey, pygame.RLEACCEL)
+        center = (offset, offset)
+        if kind == "circle":
+            pygame.draw.circle(sprite, color, center, radius)
+        elif kind == "key_cap":
+            pygame.draw.rect(sprite, color, ((offset - (KEY_WIDTH), offset - (LINE_WIDTH*3)),(KEY_WIDTH*2 + LINE_WIDTH//2, (LINE_WIDTH * 6))),
+                             border_radius=KEY_BORDER_RADIUS)
+        else:
+            draw_circle_to_rect_gradient(sprite, color, center, radius, kind == "key_outline")
+        return sprite, offset
+
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    # Inputs can be picked by index or part of their name: python midi_art.py Launchkey "Drum Pad"
+    main(input_ports=[int(arg) if arg.lstrip("-").isdigit() else arg for arg in sys.argv[1:]] or None)
\ No newline at end of file
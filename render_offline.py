@@ -0,0 +1,86 @@
+"""Paint .mid files straight to PNG without a window or real-time playback.
+
+Runs the same time loop as midi_art.main() as fast as possible, one file per
+process:
+
+    python render_offline.py recorded_output*.mid --every 60 --out renders
+"""
+import argparse
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+os.environ.setdefault("SDL_VIDEODRIVER", "dummy")
+
+import numpy as np
+import pygame
+from mido import MidiFile
+
+from midi_art import (DIMENSIONS, NOTE_COLORS, NOTE_DTYPE, PITCH_X_LUT, SCREEN_HEIGHT, TIME_LOOP,
+                      SpriteCache, decay_velocity, draw_background, draw_notes, file_notes, update_held_notes)
+
+FRAME_TIME = 1/60
+
+def render_file(path: str, out_dir: str, every: int = 0, auto_color: bool = True) -> str:
+    """Render one file, returns the path of the final image"""
+    notes = list(file_notes(MidiFile(path)))
+    name = os.path.splitext(os.path.basename(path))[0]
+    canvas = pygame.Surface(DIMENSIONS)
+    draw_background(canvas)
+    sprites = SpriteCache()
+
+    held_notes = {}
+    color_index = 0
+    last_loop_time = None
+    current_time = 0
+    next_note = 0
+    frame = 0
+    # Stop once every note has been read and nothing held still paints
+    while next_note < len(notes) or any(velocity > 1 for velocity in held_notes.values()):
+        current_time += FRAME_TIME
+        looped_time = current_time % TIME_LOOP
+        time_to_reset = int(current_time / TIME_LOOP)
+        if time_to_reset != last_loop_time:
+            last_loop_time = time_to_reset
+            if auto_color:
+                color_index = (color_index + 1) % len(NOTE_COLORS)
+
+        while next_note < len(notes) and notes[next_note][0] <= current_time:
+            update_held_notes(held_notes, *notes[next_note][1:])
+            next_note += 1
+
+        # Notes are never undone here, so they can be painted as soon as they are added
+        time_marker_y = int((looped_time / TIME_LOOP) * SCREEN_HEIGHT)
+        new_notes = np.array([(PITCH_X_LUT[pitch], time_marker_y, color_index, pitch, velocity, current_time, 0, True)
+                              for pitch, velocity in held_notes.items() if velocity > 1], dtype=NOTE_DTYPE)
+        draw_notes(canvas, new_notes, current_time, False, False, sprites)
+        for pitch in held_notes:
+            held_notes[pitch] = decay_velocity(held_notes[pitch])
+
+        frame += 1
+        if every and frame % every == 0:
+            pygame.image.save(canvas, os.path.join(out_dir, f"{name}_{frame:06d}.png"))
+
+    output_filename = os.path.join(out_dir, name + ".png")
+    pygame.image.save(canvas, output_filename)
+    return output_filename
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("files", nargs="+", help=".mid files to render")
+    parser.add_argument("--out", default=".", help="directory for the images")
+    parser.add_argument("--every", type=int, default=0, help="also save every Nth frame")
+    parser.add_argument("--jobs", type=int, default=os.cpu_count(), help="files rendered at once")
+    parser.add_argument("--fixed-color", action="store_true", help="don't change color every loop")
+    args = parser.parse_args()
+
+    os.makedirs(args.out, exist_ok=True)
+    start = time.perf_counter()
+    with ProcessPoolExecutor(max_workers=min(args.jobs, len(args.files))) as pool:
+        futures = [pool.submit(render_file, path, args.out, args.every, not args.fixed_color) for path in args.files]
+        for path, future in zip(args.files, futures):
+            print(f"{path} -> {future.result()}")
+    print(f"rendered {len(args.files)} files in {time.perf_counter() - start:.1f}s")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,54 @@
+import numpy as np
+
+from midi_art import NoteStore
+
+
+def held_stroke(store: NoteStore, count: int, start_time: float, pitch: int = 60) -> int:
+    stroke = store.new_stroke()
+    for step in range(count):
+        store.append(0, step, 0, pitch, 100, start_time + step, stroke)
+    return stroke
+
+
+def test_redo_after_the_undone_stroke_expired():
+    store = NoteStore(8)
+    held_stroke(store, 3, 0)
+    assert len(store.undo()) == 3
+    store.expire(10)
+    assert len(store.redo()) == 0
+    assert len(store) == 0
+
+
+def test_undo_skips_a_stroke_that_expired_behind_a_held_one():
+    store = NoteStore(8)
+    held = store.new_stroke()
+    store.append(0, 0, 0, 60, 100, 0, held)
+    tapped = held_stroke(store, 2, 1, pitch=64)
+    store.append(0, 1, 0, 60, 100, 5, held)
+    store.expire(4)  # The held stroke's first note and every note of the tapped one
+    assert tapped in store.strokes
+    removed = store.undo()
+    assert removed["stroke"].tolist() == [held]
+    assert not store.ordered()["alive"].any()
+    assert store.redo()["stroke"].tolist() == [held]
+
+
+def test_redo_keeps_notes_added_to_a_held_stroke_after_undo():
+    store = NoteStore(16)
+    stroke = held_stroke(store, 5, 0)
+    assert len(store.undo()) == 5
+    store.append(0, 5, 0, 60, 100, 5, stroke)
+    assert len(store.redo()) == 5
+    assert len(store.undo()) == 6
+    assert not np.any(store.ordered()["alive"])
+
+
+def test_expire_and_since_across_the_wrap():
+    store = NoteStore(8)
+    held_stroke(store, 6, 0)
+    store.expire(4)
+    held_stroke(store, 4, 6)
+    assert store.head % 8 > store.tail % 8
+    assert store.since(store.tail - 3)["time"].tolist() == [7, 8, 9]
+    assert store.expire(7.5)["time"].tolist() == [4, 5, 6, 7]
+    assert store.ordered()["time"].tolist() == [8, 9]